@@ -1,10 +1,16 @@
+import os
 import time
+import queue
 import struct
 import threading
+import ctypes
+import ctypes.util
+from collections import OrderedDict
 from jnius import autoclass, cast
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
@@ -28,6 +34,128 @@ PythonActivity = autoclass('org.kivy.android.PythonActivity')
 MESH_UUID = '0000181B-0000-1000-8000-00805F9B34FB'
 MAX_PAYLOAD_SIZE = 23
 TTL_DEFAULT = 7
+_MESH_PARCEL_UUID = ParcelUuid.fromString(MESH_UUID)
+BROADCAST_ID = 0xFFFF
+SEEN_CACHE_SIZE = 1024
+TX_QUEUE_SIZE = 64
+SCAN_REPORT_DELAY_MS = 100
+ADVERTISE_START_TIMEOUT = 0.1  # seconds to wait for onStartSuccess
+ADVERTISE_EVENT_TIME = 0.01  # one advertising event covers all three channels in under 10ms
+MAX_DISPLAYED_MESSAGES = 100
+AES_BLOCK_SIZE = 16
+_HDR = struct.Struct('>BHHBH')  # opcode, source, destination, TTL, sequence number
+_NONCE = struct.Struct('>HH12x')  # source node ID, sequence number, zero counter
+
+
+def _parse_and_dedup(scan_record, seen, node_id):
+    """Parse a mesh packet and record it in the seen cache.
+
+    Returns (opcode, source_id, destination_id, ttl, seq_num, payload), or None
+    for packets that are malformed, expired, our own, or already handled.
+    Kept free of Java objects so PyPy can trace it as plain Python.
+    """
+    if len(scan_record) < _HDR.size:
+        return None
+
+    # Slice through a memoryview so the payload is only copied where needed
+    mv = memoryview(scan_record)
+    opcode, source_id, destination_id, ttl, seq_num = _HDR.unpack_from(mv)
+    if ttl <= 0 or source_id == node_id:
+        return None
+
+    # Neighbours relay every packet, so drop copies before paying for AES
+    key = (source_id, seq_num)
+    if key in seen:
+        return None
+    seen[key] = None
+    if len(seen) > SEEN_CACHE_SIZE:
+        seen.popitem(last=False)
+    return opcode, source_id, destination_id, ttl, seq_num, mv[_HDR.size:]
+
+
+class _NativeAesCtr:
+    """AES-CTR through libcrypto's EVP API with contexts initialised once."""
+
+    def __init__(self, lib, key):
+        self._lib = lib
+        lib.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+        lib.EVP_CIPHER_CTX_free.argtypes = [ctypes.c_void_p]
+        cipher_fn = getattr(lib, f'EVP_aes_{len(key) * 8}_ctr')
+        cipher_fn.restype = ctypes.c_void_p
+        init_args = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        update_args = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_int),
+                       ctypes.c_char_p, ctypes.c_int]
+        lib.EVP_EncryptInit_ex.argtypes = init_args
+        lib.EVP_DecryptInit_ex.argtypes = init_args
+        lib.EVP_EncryptUpdate.argtypes = update_args
+        lib.EVP_DecryptUpdate.argtypes = update_args
+
+        self._enc_ctx = lib.EVP_CIPHER_CTX_new()
+        self._dec_ctx = lib.EVP_CIPHER_CTX_new()
+        if not self._enc_ctx or not self._dec_ctx:
+            raise OSError("EVP_CIPHER_CTX_new failed")
+        if (lib.EVP_EncryptInit_ex(self._enc_ctx, cipher_fn(), None, key, None) != 1
+                or lib.EVP_DecryptInit_ex(self._dec_ctx, cipher_fn(), None, key, None) != 1):
+            raise OSError("EVP cipher init failed")
+        # Encrypt (send) and decrypt (scan) run on different threads, so
+        # each direction owns its output buffer
+        self._enc_out = (ctypes.create_string_buffer(2 * AES_BLOCK_SIZE), ctypes.c_int())
+        self._dec_out = (ctypes.create_string_buffer(2 * AES_BLOCK_SIZE), ctypes.c_int())
+
+    @classmethod
+    def load(cls, key):
+        """Return a native cipher, or None when libcrypto is unavailable."""
+        path = ctypes.util.find_library('crypto')
+        if path is None:
+            return None
+        try:
+            return cls(ctypes.CDLL(path), key)
+        except (OSError, AttributeError):
+            return None
+
+    @staticmethod
+    def _update(init_fn, update_fn, ctx, out, nonce, data):
+        out_buf, out_len = out
+        data = bytes(data)  # ctypes wants bytes; no copy when it already is
+        if len(data) > len(out_buf):
+            out_buf = ctypes.create_string_buffer(len(data))
+        # Only the IV changes per message; cipher and key schedule are kept
+        if (init_fn(ctx, None, None, None, nonce) != 1
+                or update_fn(ctx, out_buf, ctypes.byref(out_len), data, len(data)) != 1):
+            raise ValueError("EVP update failed")
+        return ctypes.string_at(out_buf, out_len.value)
+
+    def encrypt(self, nonce, data):
+        lib = self._lib
+        return self._update(lib.EVP_EncryptInit_ex, lib.EVP_EncryptUpdate,
+                            self._enc_ctx, self._enc_out, nonce, data)
+
+    def decrypt(self, nonce, data):
+        lib = self._lib
+        return self._update(lib.EVP_DecryptInit_ex, lib.EVP_DecryptUpdate,
+                            self._dec_ctx, self._dec_out, nonce, data)
+
+    def __del__(self):
+        for ctx in (getattr(self, '_enc_ctx', None), getattr(self, '_dec_ctx', None)):
+            if ctx:
+                self._lib.EVP_CIPHER_CTX_free(ctx)
+
+
+class _AdvertiseCallback:
+    """Advertise callback that signals when its own start has completed."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.failed = False
+
+    def onStartSuccess(self, settings):
+        self.done.set()
+
+    def onStartFailure(self, error_code):
+        print(f"Advertising failed: {error_code}")
+        self.failed = True
+        self.done.set()
+
 
 class BluetoothMeshComm:
     def __init__(self, node_id, network_key):
@@ -39,32 +167,95 @@ class BluetoothMeshComm:
         self.scanner = self.adapter.getBluetoothLeScanner()
         self.running = False
         self.message_callback = None
-        self.sequence_number = 0
+        # The sequence number is part of the CTR nonce; start at a random point
+        # so a restarted node does not replay the keystreams of its last run
+        self.sequence_number = int.from_bytes(os.urandom(2), 'big')
+        self._seq_lock = threading.Lock()
+        self._tx_queue = queue.Queue(maxsize=TX_QUEUE_SIZE)
+        self._tx_thread = None
+        self._seen = OrderedDict()  # (source_id, seq_num) of recently handled packets
+        # Reuse the algorithm and backend objects across messages; the fallback
+        # path still builds a fresh cipher context per call
+        self._aes_algo = algorithms.AES(network_key)
+        self._backend = default_backend()
+        # Single-block payloads are dominated by wrapper overhead; go straight
+        # to libcrypto when we can find it
+        self._native_aes = _NativeAesCtr.load(network_key)
+        # Advertising parameters never change, so build the Java objects once
+        self._presence_settings = AdvertiseSettings.Builder() \
+            .setAdvertiseMode(AdvertiseSettings.ADVERTISE_MODE_LOW_POWER) \
+            .setTxPowerLevel(AdvertiseSettings.ADVERTISE_TX_POWER_LOW) \
+            .setConnectable(False) \
+            .build()
+        self._presence_data = AdvertiseData.Builder() \
+            .addServiceUuid(_MESH_PARCEL_UUID) \
+            .build()
+        self._packet_settings = AdvertiseSettings.Builder() \
+            .setAdvertiseMode(AdvertiseSettings.ADVERTISE_MODE_LOW_LATENCY) \
+            .setTxPowerLevel(AdvertiseSettings.ADVERTISE_TX_POWER_MEDIUM) \
+            .setConnectable(False) \
+            .build()
 
     def start(self):
         """Start the mesh network."""
+        if self.running:
+            return
         if not self.adapter.isEnabled():
             print("Bluetooth not enabled")
             return
         self.running = True
         self._start_scanning()
-        threading.Thread(target=self._advertise_presence, daemon=True).start()
+        self._start_advertising()
+        self._tx_thread = threading.Thread(target=self._tx_worker, daemon=True)
+        self._tx_thread.start()
 
     def stop(self):
         """Stop the mesh network."""
+        if not self.running:
+            return
         self.running = False
+        # Discard unsent packets so they are not sent after a restart, then
+        # wake the TX worker and wait for it so only one ever runs
+        while True:
+            try:
+                self._tx_queue.get_nowait()
+            except queue.Empty:
+                break
+        self._tx_queue.put(None)
+        self._tx_thread.join()
+        self._tx_thread = None
         self.scanner.stopScan(self.scan_callback)
         self.advertiser.stopAdvertising(self.advertise_callback)
 
     def send_message(self, destination_id, text):
         """Send a text message."""
+        if not self.running:
+            print("Mesh network not running")
+            return
         if len(text) > MAX_PAYLOAD_SIZE:
             print("Message too long")
             return
         payload = text.encode('utf-8')
-        encrypted_payload = self._encrypt_payload(payload)
-        packet = self._create_mesh_packet(destination_id, 0x01, encrypted_payload)
-        self._advertise_packet(packet)
+        seq_num = self._next_sequence_number()
+        encrypted_payload = self._encrypt_payload(payload, self.node_id, seq_num)
+        packet = self._create_mesh_packet(destination_id, 0x01, encrypted_payload, seq_num)
+        self._queue_packet(packet)
+
+    def _queue_packet(self, packet):
+        """Hand a packet to the TX worker, dropping it if stopped or the queue is full."""
+        if not self.running:
+            return
+        try:
+            self._tx_queue.put_nowait(packet)
+        except queue.Full:
+            print("TX queue full, dropping packet")
+
+    def _tx_worker(self):
+        """Advertise queued packets off the UI and scan callback threads."""
+        while self.running:
+            packet = self._tx_queue.get()
+            if packet is not None and self.running:
+                self._advertise_packet(packet)
 
     def _start_scanning(self):
         """Start scanning for mesh messages."""
@@ -76,102 +267,99 @@ class BluetoothMeshComm:
                 scan_record = result.getScanRecord().getBytes()
                 self.mesh._process_mesh_message(scan_record)
 
-        self.scan_callback = ScanCallback(self)
-        scan_filter = ScanFilter.Builder().setServiceUuid(ParcelUuid.fromString(MESH_UUID)).build()
-        scan_settings = ScanSettings.Builder().setScanMode(ScanSettings.SCAN_MODE_LOW_POWER).build()
-        self.scanner.startScan([scan_filter], scan_settings, self.scan_callback)
-
-    def _advertise_presence(self):
-        """Advertise node presence periodically."""
-        class AdvertiseCallback:
-            def onStartSuccess(self, settings):
-                pass
+            def onBatchScanResults(self, results):
+                for result in results.toArray():
+                    self.mesh._process_mesh_message(result.getScanRecord().getBytes())
 
-            def onStartFailure(self, error_code):
-                print(f"Advertising failed: {error_code}")
-
-        self.advertise_callback = AdvertiseCallback()
-        settings = AdvertiseSettings.Builder() \
-            .setAdvertiseMode(AdvertiseSettings.ADVERTISE_MODE_LOW_POWER) \
-            .setTxPowerLevel(AdvertiseSettings.ADVERTISE_TX_POWER_LOW) \
-            .setConnectable(False) \
-            .build()
-        data = AdvertiseData.Builder() \
-            .addServiceUuid(ParcelUuid.fromString(MESH_UUID)) \
+        self.scan_callback = ScanCallback(self)
+        scan_filter = ScanFilter.Builder().setServiceUuid(_MESH_PARCEL_UUID).build()
+        # Batch results in the controller where possible so one callback
+        # delivers many packets
+        report_delay = SCAN_REPORT_DELAY_MS if self.adapter.isOffloadedScanBatchingSupported() else 0
+        scan_settings = ScanSettings.Builder() \
+            .setScanMode(ScanSettings.SCAN_MODE_BALANCED) \
+            .setCallbackType(ScanSettings.CALLBACK_TYPE_ALL_MATCHES) \
+            .setReportDelay(report_delay) \
             .build()
+        self.scanner.startScan([scan_filter], scan_settings, self.scan_callback)
 
-        while self.running:
-            self.advertiser.startAdvertising(settings, data, self.advertise_callback)
-            time.sleep(5.0)
-            self.advertiser.stopAdvertising(self.advertise_callback)
+    def _start_advertising(self):
+        """Start the presence beacon; it stays up until stop()."""
+        self.advertise_callback = _AdvertiseCallback()
+        self.advertiser.startAdvertising(self._presence_settings, self._presence_data,
+                                         self.advertise_callback)
 
     def _advertise_packet(self, packet):
         """Advertise a specific packet."""
-        settings = AdvertiseSettings.Builder() \
-            .setAdvertiseMode(AdvertiseSettings.ADVERTISE_MODE_LOW_LATENCY) \
-            .setTxPowerLevel(AdvertiseSettings.ADVERTISE_TX_POWER_MEDIUM) \
-            .setConnectable(False) \
-            .build()
         data = AdvertiseData.Builder() \
-            .addServiceUuid(ParcelUuid.fromString(MESH_UUID)) \
-            .addServiceData(ParcelUuid.fromString(MESH_UUID), packet) \
+            .addServiceUuid(_MESH_PARCEL_UUID) \
+            .addServiceData(_MESH_PARCEL_UUID, packet) \
             .build()
-        self.advertiser.startAdvertising(settings, data, self.advertise_callback)
-        time.sleep(0.1)
-        self.advertiser.stopAdvertising(self.advertise_callback)
+        # Android keys each advertising set by its callback. A fresh one per
+        # packet keeps the presence beacon untouched and means a late
+        # onStartSuccess from an earlier packet cannot end this one early
+        callback = _AdvertiseCallback()
+        self.advertiser.startAdvertising(self._packet_settings, data, callback)
+        # Stop as soon as the first advertising event is out instead of
+        # sleeping for a fixed 100ms
+        if callback.done.wait(ADVERTISE_START_TIMEOUT) and not callback.failed:
+            time.sleep(ADVERTISE_EVENT_TIME)
+        self.advertiser.stopAdvertising(callback)
 
-    def _create_mesh_packet(self, destination_id, opcode, payload, ttl=TTL_DEFAULT):
-        """Create a mesh packet."""
-        packet = bytearray(8 + len(payload))
-        packet[0] = opcode
-        struct.pack_into('>HHBH', packet, 1, self.node_id, destination_id, ttl, self.sequence_number)
-        packet[7:] = payload
-        self.sequence_number = (self.sequence_number + 1) % 0xFFFF
-        return bytes(packet)
+    def _next_sequence_number(self):
+        """Reserve the next 16-bit sequence number for a packet from this node."""
+        with self._seq_lock:
+            seq_num = self.sequence_number
+            self.sequence_number = (seq_num + 1) & 0xFFFF
+        return seq_num
+
+    def _create_mesh_packet(self, destination_id, opcode, payload, seq_num, ttl=TTL_DEFAULT):
+        """Create a mesh packet originating from this node."""
+        return _HDR.pack(opcode, self.node_id, destination_id, ttl, seq_num) + payload
 
     def _process_mesh_message(self, scan_record):
         """Process received mesh message."""
-        if len(scan_record) < 8:
+        parsed = _parse_and_dedup(scan_record, self._seen, self.node_id)
+        if parsed is None:
             return
+        opcode, source_id, destination_id, ttl, seq_num, encrypted_payload = parsed
 
-        opcode = scan_record[0]
-        source_id = struct.unpack('>H', scan_record[1:3])[0]
-        destination_id = struct.unpack('>H', scan_record[3:5])[0]
-        ttl = scan_record[5]
-        seq_num = struct.unpack('>H', scan_record[6:8])[0]
-        encrypted_payload = scan_record[8:]
-
-        if ttl <= 0:
-            return
-
-        payload = self._decrypt_payload(encrypted_payload)
-        if opcode == 0x01:
+        # Only decrypt what is delivered locally
+        if opcode == 0x01 and destination_id in (self.node_id, BROADCAST_ID):
+            payload = self._decrypt_payload(encrypted_payload, source_id, seq_num)
             message = payload.decode('utf-8', errors='ignore')
             if self.message_callback:
                 self.message_callback(f"Node {source_id}: {message}")
 
-        if ttl > 1 and self.running:
-            packet = self._create_mesh_packet(destination_id, opcode, payload, ttl - 1)
-            self._advertise_packet(packet)
+        # Relay the original ciphertext under the original source and sequence
+        # number, so receivers can still derive the nonce and dedup the packet
+        if ttl > 1 and destination_id != self.node_id and self.running:
+            packet = _HDR.pack(opcode, source_id, destination_id, ttl - 1, seq_num) + encrypted_payload
+            self._queue_packet(packet)
 
-    def _encrypt_payload(self, payload):
-        """Encrypt payload with AES-128."""
-        cipher = Cipher(algorithms.AES(self.network_key), modes.ECB(), default_backend())
-        encryptor = cipher.encryptor()
-        padded_payload = payload + b'\x00' * (16 - len(payload) % 16)
-        return encryptor.update(padded_payload) + encryptor.finalize()
+    def _encrypt_payload(self, payload, source_id, seq_num):
+        """Encrypt payload with AES-128-CTR keyed by the packet's source and sequence."""
+        nonce = _NONCE.pack(source_id, seq_num)
+        if self._native_aes is not None:
+            return self._native_aes.encrypt(nonce, payload)
+        encryptor = Cipher(self._aes_algo, modes.CTR(nonce), self._backend).encryptor()
+        return encryptor.update(payload) + encryptor.finalize()
 
-    def _decrypt_payload(self, encrypted_payload):
-        """Decrypt payload with AES-128."""
-        cipher = Cipher(algorithms.AES(self.network_key), modes.ECB(), default_backend())
-        decryptor = cipher.decryptor()
-        decrypted = decryptor.update(encrypted_payload) + decryptor.finalize()
-        return decrypted.rstrip(b'\x00')
+    def _decrypt_payload(self, encrypted_payload, source_id, seq_num):
+        """Decrypt payload with AES-128-CTR keyed by the packet's source and sequence."""
+        nonce = _NONCE.pack(source_id, seq_num)
+        if self._native_aes is not None:
+            return self._native_aes.decrypt(nonce, encrypted_payload)
+        decryptor = Cipher(self._aes_algo, modes.CTR(nonce), self._backend).decryptor()
+        return decryptor.update(encrypted_payload) + decryptor.finalize()
 
 class MeshCommApp(App):
     def __init__(self, **kwargs):
         super().__init__()
-        self.mesh = BluetoothMeshComm(node_id=0x0001, network_key=b'0123456789abcdef')
+        # Node IDs must differ per device: packets from our own ID are ignored
+        # and the ID seeds the CTR nonce. Pick from 1..0xFFFE (0xFFFF is broadcast)
+        node_id = int.from_bytes(os.urandom(2), 'big') % (BROADCAST_ID - 1) + 1
+        self.mesh = BluetoothMeshComm(node_id=node_id, network_key=b'0123456789abcdef')
         self.mesh.message_callback = self.add_message
 
     def build(self):
@@ -200,12 +388,19 @@ class MeshCommApp(App):
         return layout
 
     def add_message(self, message):
+        # Called from the BLE scan thread; widgets may only be touched on the UI thread
+        Clock.schedule_once(lambda dt: self._show_message(message), 0)
+
+    def _show_message(self, message):
         self.message_display.add_widget(Label(text=message, size_hint_y=None, height=30))
+        # Kivy keeps the newest child first, so trim from the end
+        if len(self.message_display.children) > MAX_DISPLAYED_MESSAGES:
+            self.message_display.remove_widget(self.message_display.children[-1])
 
     def send_message(self, instance):
         text = self.text_input.text.strip()
         if text:
-            self.mesh.send_message(0xFFFF, text)
+            self.mesh.send_message(BROADCAST_ID, text)
             self.text_input.text = ''
 
 if __name__ == '__main__':